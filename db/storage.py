@@ -14,7 +14,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-ROOT_DIR = Path().cwd()
+ROOT_DIR = Path(__file__).resolve().parent.parent
 with open(f"{ROOT_DIR}/config.json", 'r') as file:
     config = json.load(file)
 
@@ -129,7 +129,8 @@ class MySQLClient:
         Returns:
             None
         """
-        df['waterBody'] = df['waterBody'].apply(lambda x: None if pd.isna(x) else x)
+        # pymysql only sends None as NULL, so missing values (NaN, pd.NA in Int64 columns) are replaced with it
+        df = df.astype(object).where(df.notna(), None)
 
         try:
             logger.info('Inserting rows.')
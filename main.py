@@ -6,7 +6,7 @@ pipeline = typer.Typer()
 
 
 @pipeline.command('main')
-def main(whale: str, startdate: str='', enddate: str=''):
+def main(whale: str, startdate: str='', enddate: str='', legacy_csv: bool=False):
     """
     Pipeline orchestration
     """
@@ -15,7 +15,7 @@ def main(whale: str, startdate: str='', enddate: str=''):
     handler.batch_requests()
     validator = validate.Validator(whale, startdate, enddate)
     valid_data, error_data = validator.validate_response()
-    datacleaner = cleaner.WhaleDataCleaner(whale, valid_data, error_data, startdate, enddate)
+    datacleaner = cleaner.WhaleDataCleaner(whale, valid_data, error_data, startdate, enddate, legacy_csv)
     df = datacleaner.process_and_save()
 
     mysqlclient = MySQLClient()
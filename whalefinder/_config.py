@@ -0,0 +1,62 @@
+from functools import lru_cache
+import json
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+@lru_cache(maxsize=None)
+def get_config() -> dict:
+    """
+    Load config.json once per process
+
+    Returns:
+        dict
+    """
+    with open(f"{ROOT_DIR}/config.json", 'r') as file:
+        return json.load(file)
+
+
+def get_whales() -> dict:
+    """
+    Whales dictionary from config.json
+
+    Returns:
+        dict
+    """
+    return get_config()['whales']
+
+
+def check_whale(whale: str) -> str:
+    """
+    Check that a whale is in the whales dictionary
+
+    Args:
+        whale: str
+    Returns:
+        str, the whale unchanged
+    Raises:
+        ValueError: if the whale isn't in the whales dictionary
+    """
+    whales = get_whales()
+    if whale not in whales:
+        raise ValueError(f'{whale} not in whales dictionary. {whales.keys()}')
+    return whale
+
+
+@lru_cache(maxsize=None)
+def get_session() -> requests.Session:
+    """
+    Create the requests session shared by every ApiClient, on first use rather than at import.
+    The only host is api.obis.org, so a single pool is sized for concurrent /occurrence requests
+    and blocks rather than opening throwaway connections when it is exhausted.
+
+    Returns:
+        requests.Session
+    """
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=16, pool_block=True, max_retries=retries))
+    return session
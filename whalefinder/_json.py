@@ -0,0 +1,39 @@
+import json
+from typing import Any
+
+# orjson parses and serializes several times faster than the json module, fall back to json if it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def load(path) -> Any:
+    """
+    Load a json file
+
+    Args:
+        path: str | Path
+            file to read
+    Returns:
+        parsed json
+    """
+    with open(path, 'rb') as file:
+        if orjson is not None:
+            return orjson.loads(file.read())
+        return json.load(file)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialize an object to compact utf-8 encoded json
+
+    Args:
+        obj: Any
+            object to serialize
+    Returns:
+        bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
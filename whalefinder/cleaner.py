@@ -1,7 +1,7 @@
 from calendar import monthrange
 import datetime
+from functools import lru_cache
 import geopandas as gpd
-import json
 import logging
 from logging import INFO
 import pandas as pd
@@ -10,24 +10,67 @@ import re
 import sys
 from typing import Optional
 
+from . import _json
+from ._config import check_whale
+
 logging.basicConfig(format='[%(asctime)s][%(module)s:%(lineno)04d] : %(message)s', level=INFO, stream=sys.stderr)
 logger = logging.getLogger(__name__)
 
-ROOT_DIR = Path().cwd()
-with open(f"{ROOT_DIR}/config.json", 'r') as file:
-    config = json.load(file)
-whales = config['whales']
-
-
+_TEXT_DATE_RES = (
+    re.compile(r'^[A-Za-z]+ \d{4}$'),  # January 2000
+    re.compile(r'^\d{4} [A-Za-z]+$'),  # 2000 January
+    re.compile(r'^\d{1,2} [A-Za-z]+$'),  # 07 January
+    re.compile(r'^[A-Za-z]+ \d{1,2}$')  # January 07
+)
+# paired with strptime formats for abbreviated and non-abbreviated months
+_TEXT_DATE_FORMATS = tuple(zip(_TEXT_DATE_RES * 2, (
+    '%b %Y',
+    '%Y %b',
+    '%d %b',
+    '%b %d',
+    '%B %Y',
+    '%Y %B',
+    '%d %B',
+    '%B %d'
+)))
+_VALID_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+# time of day and timezone suffix of an ISO datetime, e.g. 'T10:00:00Z'
+_TIME_RE = re.compile(r'T.*')
+
+# Column dtypes for numeric Results fields, strings are left as object columns
+RESULTS_DTYPES = {
+    'decimalLatitude': 'float64',
+    'decimalLongitude': 'float64',
+    'speciesid': 'Int64',
+    'individualCount': 'Int64'
+}
+
+OCEANS_SHAPEFILE = Path('data/Global_Oceans_and_Seas_version_1/goas_v01.shp')
+OCEANS_PARQUET = Path('data/oceans.parquet')
+CRS = 'EPSG:4326'
+
+
+@lru_cache(maxsize=None)
 def load_oceans() -> gpd.GeoDataFrame:
     """
-    Load a shape file containing ocean geographic data into a GeoDataFrame
+    Load ocean geographic data into a GeoDataFrame.
+    The shapefile is converted to GeoParquet on first use, later loads read the parquet copy.
     
     Returns:
         geopandas.GeoDataFrame
     """
+    if OCEANS_PARQUET.exists():
+        logger.info('Loading ocean parquet..')
+        return gpd.read_parquet(OCEANS_PARQUET)
+
     logger.info('Loading ocean shapefile..')
-    gdf = gpd.read_file('data/Global_Oceans_and_Seas_version_1/goas_v01.shp')
+    gdf = gpd.read_file(OCEANS_SHAPEFILE)
+    # project the polygons once so whale points never need reprojecting
+    if gdf.crs != CRS:
+        gdf = gdf.to_crs(CRS)
+    logger.info('Saving ocean parquet to %s', OCEANS_PARQUET)
+    gdf.to_parquet(OCEANS_PARQUET)
     return gdf
 
 
@@ -39,7 +82,7 @@ class WhaleDataCleaner:
 
     def __init__(
             self, whale: str, valid_data: dict, error_data: dict,
-            startdate: Optional[str]=None, enddate: Optional[str]=None
+            startdate: Optional[str]=None, enddate: Optional[str]=None, legacy_csv: bool=False
     ) -> None:
         """
         Args:
@@ -48,17 +91,17 @@ class WhaleDataCleaner:
             valid_data, error_data: dict
                 Data to process. If errors pass checks, they'll be processed with valid data
             startdate, enddate: str
-                Used for csv writing.
+                Used for output file naming.
                 If no arguments are supplied, a function call will get values
+            legacy_csv: bool, default False
+                Also save a csv copy next to the parquet output
         """
-        if whale in whales:
-            self.whale = whale
-        else:
-            raise ValueError(f'{whale} not in whales dictionary. {whales.keys()}')
+        self.whale = check_whale(whale)
         self.start = startdate
         self.end = enddate
         self.valid_data = valid_data
         self.error_data = error_data
+        self.legacy_csv = legacy_csv
 
     def fill_in(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -70,46 +113,64 @@ class WhaleDataCleaner:
         Returns:
             `pd.DataFrame`
         """
-        # replace null occurrence ids with -1, -2, -3....
+        # replace null occurrence ids with '-1', '-2', '-3'....
+        # kept as strings so the column has a single type for parquet
         nan_indices = df[df['occurrenceID'].isnull()].index
         for i, index in enumerate(nan_indices, start=1):
-            df.loc[index, 'occurrenceID'] = -i
+            df.loc[index, 'occurrenceID'] = str(-i)
 
         whale = self.whale
         whale = whale.replace('_', ' ').title()
         df['vernacularName'] = df['vernacularName'].fillna(whale)
         return df
 
+    def set_dtypes(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Cast known numeric columns to explicit dtypes instead of leaving them to inference.
+        Values that aren't numbers, or aren't whole numbers in integer columns, become missing values
+
+        Args:
+            df: pd.DataFrame
+        Returns:
+            `pd.DataFrame`
+        """
+        converted = {}
+        for col, dtype in RESULTS_DTYPES.items():
+            if col not in df.columns:
+                continue
+            values = pd.to_numeric(df[col], errors='coerce')
+            if dtype == 'Int64':
+                values = values.where(values % 1 == 0)
+            converted[col] = values.astype(dtype)
+        return df.assign(**converted)
+
+    def set_str_dtypes(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Cast the remaining object columns to str, keeping missing values.
+        Raw values of processed error records can mix types within a column, which parquet can't store
+
+        Args:
+            df: pd.DataFrame
+        Returns:
+            `pd.DataFrame`
+        """
+        converted = {}
+        for col in df.select_dtypes(include='object').columns:
+            values = df[col]
+            converted[col] = values.where(values.isna(), values.astype(str))
+        return df.assign(**converted)
+
     def split_dates(self, date_str: str) -> tuple:
         """
         Split the different formats that the eventDate field comes in into
         start_year, start_month, start_day and end_year, end_month, end_day.
         """
-        reg_text_formats = [
-            r'^[A-Za-z]+ \d{4}$',  # January 2000
-            r'^\d{4} [A-Za-z]+$',  # 2000 January
-            r'^\d{1,2} [A-Za-z]+$',  # 07 January
-            r'^[A-Za-z]+ \d{1,2}$'  # January 07
-            ]
-
-        # formats for abbreviated and non-abbreviated months
-        parsed_formats = [
-            '%b %Y',
-            '%Y %b',
-            '%d %b',
-            '%b %d',
-            '%B %Y',
-            '%Y %B',
-            '%d %B',
-            '%B %d'
-            ]
-
         # remove any potential commas and leading/trailing whitespace
         date_str = date_str.replace(',', '').lstrip(' ').rstrip(' ')
 
         # PARSING DATES WITH LETTER CHARACTERS
-        for r_fmt, p_fmt in zip((reg_text_formats) * 2, parsed_formats):
-            if re.match(r_fmt, date_str):
+        for r_fmt, p_fmt in _TEXT_DATE_FORMATS:
+            if r_fmt.match(date_str):
                 try:
                     date = datetime.strptime(date_str, p_fmt).date()
                     # if no date value was present in the date_str format
@@ -127,9 +188,8 @@ class WhaleDataCleaner:
             if '/' in date_str and '-' in date_str:
                 start_date, end_date = date_str.split('/')
                 # Remove any potential timezone strings
-                time_format = re.compile(r'T.*')
-                start_date = re.sub(time_format, '', start_date)
-                end_date = re.sub(time_format, '', end_date)
+                start_date = _TIME_RE.sub('', start_date)
+                end_date = _TIME_RE.sub('', end_date)
                 start_year, start_month, start_day = start_date.split('-')
                 end_year, end_month, end_day = end_date.split('-')
                 return tuple(map(int, (start_year, start_month, start_day, end_year, end_month, end_day)))
@@ -161,15 +221,14 @@ class WhaleDataCleaner:
                 return int(date_str), 1, 1, int(date_str), 12, 31
             
         except ValueError:
-            logger.info(f"Failed to process incorrect date format: {date_str}")
+            logger.info("Failed to process incorrect date format: %s", date_str)
             return tuple([0]) * 6
 
     def is_valid_date(self, date_str: str) -> bool:
         """
         Returns bool value to be passed to DataFrame column
         """
-        format = r'^\d{4}-\d{2}-\d{2}$'
-        if re.match(format, date_str):
+        if _VALID_DATE_RE.match(date_str):
             return True
         else:
             return False
@@ -198,6 +257,21 @@ class WhaleDataCleaner:
         else:
             pass
 
+    def drop_duplicate_sightings(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Remove rows sharing the same eventDate, decimalLatitude and decimalLongitude, keeping the first.
+        Rows are compared through one uint64 hash per row rather than three object columns.
+
+        Args:
+            df: pd.DataFrame
+        Returns:
+            `pd.DataFrame`
+        """
+        row_hashes = pd.util.hash_pandas_object(df[['eventDate', 'decimalLatitude', 'decimalLongitude']], index=False)
+        duplicated = row_hashes.duplicated(keep='first')
+        logger.info("%d duplicate rows removed", duplicated.sum())
+        return df[~duplicated.to_numpy()]
+
     def get_ocean(self, df: pd.DataFrame) -> pd.DataFrame:
         """Check for longitude/latitude point intersections 
         between an ocean GeoDataFrame and whale GeoDataFrame to get consistent ocean locations
@@ -210,8 +284,13 @@ class WhaleDataCleaner:
         """
         ocean_gdf = load_oceans()
         # Generate whale geodataframe with geometry point column using longitude(x),latitude(y) values
+        # Only rows with both coordinates get a point, the rest can't intersect anything
         logger.info("Performing geodata operations..")
-        points_df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['decimalLongitude'], df['decimalLatitude']), crs='EPSG:4326')
+        has_coords = df[['decimalLatitude', 'decimalLongitude']].notna().all(axis=1)
+        coords = df.loc[has_coords, ['decimalLongitude', 'decimalLatitude']]
+        points_df = gpd.GeoDataFrame(
+            geometry=gpd.points_from_xy(coords['decimalLongitude'], coords['decimalLatitude']), index=coords.index, crs=CRS
+        )
         # Create joined_df from spatial join intersections between points and polygons
         joined_df = gpd.sjoin(points_df, ocean_gdf, how='left', predicate='intersects')
         # Update waterBody names
@@ -247,13 +326,14 @@ class WhaleDataCleaner:
             error_df = pd.concat(dataframes)
             return error_df
         else:
-            logger.info(f"No errors present")
+            logger.info("No errors present")
             error_df = pd.DataFrame({'': []})
             return error_df 
 
     def error_df_to_json(self, error_df: pd.DataFrame) -> None:
         """
-        Convert failed error processing attempts back to a dictionary and save to json
+        Convert failed error processing attempts back to dictionaries and save to newline delimited json,
+        one error per line
 
         Args:
             error_df: pd.DataFrame
@@ -265,6 +345,8 @@ class WhaleDataCleaner:
         whale = self.whale
         output_dir = Path(f"{data_dir}/{whale}/errors")
         output_dir.mkdir(parents=True, exist_ok=True)
+        # replace NaN values with None, so they're saved as null
+        error_df = error_df.astype(object).where(error_df.notna(), None)
 
         for (error_index, detail_index), row in error_df.iterrows():
             # access df column and row's column value
@@ -280,17 +362,9 @@ class WhaleDataCleaner:
             # append details to the correct error dictionary
             error_dict[error_index]['details'].append(details)
 
-        error_dict = {'errors': [error for index, error in error_dict.items()]}
-
-        # replace NaN values with null
-        nan_regex_pattern = re.compile(r'\bnan\b', re.IGNORECASE)
-        error_dict = json.dumps(error_dict, ensure_ascii=False)
-        error_dict = re.sub(nan_regex_pattern, 'null', error_dict)
-        error_dict = json.loads(error_dict)
-
-        with open(f'{output_dir}/error_data.json', 'w') as file:
+        with open(f'{output_dir}/error_data.ndjson', 'wb') as file:
             print(f"Saving errors to {file.name}")
-            json.dump(error_dict, file, ensure_ascii=False, indent=4)
+            file.writelines(_json.dumps(error) + b'\n' for error in error_dict.values())
 
     def process_error_data(self, error_df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -312,11 +386,12 @@ class WhaleDataCleaner:
             processed_df.reset_index(drop=True, inplace=True)
             processed_df.drop(columns=['detail_type', 'detail_loc', 'detail_msg', 'processed'], inplace=True)
             processed_df.drop_duplicates(inplace=True)
+            processed_df = self.set_dtypes(processed_df)
 
             # save errors that failed to process
             error_df = error_df[error_df['processed'] == False]
             remaining_errors = len(error_df)
-            logger.info(f"{num_errors - remaining_errors}/{num_errors} errors processed")
+            logger.info("%d/%d errors processed", num_errors - remaining_errors, num_errors)
             if not error_df.empty:
                 self.error_df_to_json(error_df)
 
@@ -334,7 +409,8 @@ class WhaleDataCleaner:
         """
         valid_data = self.valid_data
         if valid_data['validated']:
-            df = pd.DataFrame([{k:v for k,v in item.items()} for item in valid_data['validated']])
+            df = pd.DataFrame.from_records(valid_data['validated'])
+            df = self.set_dtypes(df)
             df[['start_year', 'start_month', 'start_day', 'end_year', 'end_month', 'end_day']] = df['eventDate'].apply(lambda x: pd.Series(self.split_dates(x)))
             return df
         else:
@@ -355,27 +431,21 @@ class WhaleDataCleaner:
         if not valid_df.empty and not processed_errors_df.empty:
             merged_df = pd.concat([valid_df, processed_errors_df], ignore_index=True)
             merged_df['date_is_valid'] = merged_df['eventDate'].apply(self.is_valid_date)
-            num_duplicates = merged_df[merged_df.duplicated(subset=['eventDate', 'decimalLatitude', 'decimalLongitude'])]
-            merged_df = merged_df.drop_duplicates(subset=['eventDate', 'decimalLatitude', 'decimalLongitude'], keep='first')
-            logger.info(f"{len(num_duplicates)} duplicate rows removed")
+            merged_df = self.drop_duplicate_sightings(merged_df)
             merged_df = self.fill_in(merged_df)
             merged_df = self.get_ocean(merged_df)
             return merged_df
         
         elif not valid_df.empty and processed_errors_df.empty:
             valid_df['date_is_valid'] = valid_df['eventDate'].apply(self.is_valid_date)
-            num_duplicates = valid_df[valid_df.duplicated(subset=['eventDate', 'decimalLatitude', 'decimalLongitude'])]
-            valid_df = valid_df.drop_duplicates(subset=['eventDate', 'decimalLatitude', 'decimalLongitude'], keep='first')
-            logger.info(f"{len(num_duplicates)} duplicate rows removed")
+            valid_df = self.drop_duplicate_sightings(valid_df)
             valid_df = self.fill_in(valid_df)
             valid_df = self.get_ocean(valid_df)
             return valid_df
         
         elif not processed_errors_df.empty and valid_df.empty:
             processed_errors_df['date_is_valid'] = processed_errors_df['eventDate'].apply(self.is_valid_date)
-            num_duplicates = processed_errors_df[processed_errors_df.duplicated(subset=['eventDate', 'decimalLatitude', 'decimalLongitude'])]
-            processed_errors_df = processed_errors_df.drop_duplicates(subset=['eventDate', 'decimalLatitude', 'decimalLongitude'], keep='first')
-            logger.info(f"{len(num_duplicates)} duplicate rows removed")
+            processed_errors_df = self.drop_duplicate_sightings(processed_errors_df)
             processed_errors_df = self.fill_in(processed_errors_df)
             processed_errors_df = self.get_ocean(processed_errors_df)
             return processed_errors_df
@@ -386,7 +456,8 @@ class WhaleDataCleaner:
 
     def process_and_save(self) -> pd.DataFrame:
         """
-        Start transformation processes and save to csv file
+        Start transformation processes and save to a zstd compressed parquet file,
+        plus a csv copy if legacy_csv is set
         
         Returns:
             `pd.DataFrame`
@@ -394,9 +465,12 @@ class WhaleDataCleaner:
         output_dir = Path(f'{self.data_dir}/{self.whale}')
         output_dir.mkdir(parents=True, exist_ok=True)
 
-        merged_df = self.merge_data()
+        merged_df = self.set_str_dtypes(self.merge_data())
         self.get_start_and_end(merged_df)
-        filename = f"{output_dir}/{self.start}--{self.end}.csv"
-        logger.info(f'Saving dataframe to {filename}')
-        merged_df.to_csv(f"{filename}", index=False)
+        filename = f"{output_dir}/{self.start}--{self.end}"
+        logger.info('Saving dataframe to %s.parquet', filename)
+        merged_df.to_parquet(f"{filename}.parquet", engine='pyarrow', compression='zstd', index=False)
+        if self.legacy_csv:
+            logger.info('Saving dataframe to %s.csv', filename)
+            merged_df.to_csv(f"{filename}.csv", index=False)
         return merged_df
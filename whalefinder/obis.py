@@ -1,22 +1,21 @@
-import json
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from logging import INFO
+import os
 from pathlib import Path
 import re
 import requests
-from requests.adapters import HTTPAdapter, Retry
 import sys
 import time
 from typing import Dict, List, Optional, Tuple
 
+from . import _json
+from ._config import check_whale, get_session, get_whales
+
 logging.basicConfig(format='[%(asctime)s][%(module)s:%(lineno)04d] : %(message)s', level=INFO, stream=sys.stderr)
 logger = logging.getLogger(__name__)
 
-ROOT_DIR = Path().cwd()
-with open(f"{ROOT_DIR}/config.json", 'r') as file:
-    config = json.load(file)
-# Whales Dictionary
-whales = config['whales']
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
 
 
 class ApiClient:
@@ -24,27 +23,28 @@ class ApiClient:
     Client for the Obis API
     """
     base_url = "https://api.obis.org/v3"
-    session = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    years_url = f"{base_url}/statistics/years"
+    occurrence_url = f"{base_url}/occurrence"
 
     def __init__(self) -> None:
-        pass
+        self.session = get_session()
 
-    def request_api(self, endpoint: str, params: dict) -> requests.Response:
+    def request_api(self, url: str, params: dict, stream: bool=False) -> requests.Response:
         """
         Send a get request to the api
         
         Args:
-            endpoint: str
-                API endpoint to request
+            url: str
+                API endpoint url to request, e.g. `years_url` or `occurrence_url`
             params: dict
                 parameters to send with request
+            stream: bool, default False
+                Defer downloading the response body until it is iterated over
         Returns:
             requests.Response
         """
         try:
-            response = self.session.get(f"{self.base_url}/{endpoint}", params=params)
+            response = self.session.get(url, params=params, stream=stream)
             time.sleep(1.0)
             return response
         except requests.RequestException:
@@ -55,8 +55,12 @@ class ObisHandler:
     """Object for handling whale data from specific OBIS api endpoints
     """
     data_dir = './data'
+    # seconds that saved API responses are reused before being requested again, 0 disables reuse
+    cache_ttl = 86400
 
-    def __init__(self, api: ApiClient, whale: str, startdate: str='', enddate: str='', size: int=10000) -> None:
+    def __init__(
+            self, api: ApiClient, whale: str, startdate: str='', enddate: str='', size: int=10000, max_workers: int=4
+    ) -> None:
         """
         Args:
             api: ApiClient
@@ -69,15 +73,30 @@ class ObisHandler:
             size: int, default 10,000
                 Maximum number of allowed results returned in json response
                 The API does not accept a size limit greater than 10,000
+            max_workers: int, default 4
+                Maximum number of /occurrence requests in flight at once
         """
         self.api = api
-        if whale in whales:
-            self.whale = whale
-        else:
-            raise ValueError(f'{whale} not in whales dictionary. {whales.keys()}')
+        self.whale = check_whale(whale)
+        self.scientificname = get_whales()[whale]['scientificname']
         self.startdate = startdate
         self.enddate = enddate
         self.size = size
+        self.max_workers = max_workers
+        
+
+    def is_fresh(self, path: Path) -> bool:
+        """Check if a saved response file exists and is younger than `cache_ttl` seconds
+
+        Args:
+            path: Path
+        Returns:
+            bool
+        """
+        try:
+            return time.time() - path.stat().st_mtime < self.cache_ttl
+        except FileNotFoundError:
+            return False
         
 
     def get_records(self) -> Tuple[List[Dict], int]:
@@ -86,24 +105,35 @@ class ObisHandler:
         Returns:
             tuple[list[dict], int]
         """
-        endpoint = '/statistics/years'
-        scientificname = whales[self.whale]['scientificname']
-        params = {'scientificname': scientificname, 'startdate': self.startdate, 'enddate': self.enddate}
+        params = {'scientificname': self.scientificname, 'startdate': self.startdate, 'enddate': self.enddate}
 
-        logger.info(f"Getting records for {self.whale}")
-        records = self.api.request_api(endpoint, params)
-        records = records.json()
+        cache_file = Path(f'{self.data_dir}/{self.whale}/.cache/years_{self.startdate}--{self.enddate}.json')
+        if self.is_fresh(cache_file):
+            logger.info("Getting cached records for %s", self.whale)
+            records = _json.load(cache_file)
+        else:
+            logger.info("Getting records for %s", self.whale)
+            response = self.api.request_api(self.api.years_url, params)
+            records = response.json()
+            if response.ok:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                cache_file.write_bytes(response.content)
 
-        for record in records: record['year'] = str(record['year'])
-        num_records = sum(record['records'] for record in records)
+        num_records = 0
+        first_year = last_year = None
+        for record in records:
+            num_records += record['records']
+            last_year = record['year']
+            if first_year is None:
+                first_year = record['year']
 
         # if start or enddate are empty, default values(earliest and latest records) will be retrieved from response
         if not self.startdate:
-            self.startdate = records[0]['year']
+            self.startdate = str(first_year)
         if not self.enddate:
-            self.enddate = records[-1]['year']
+            self.enddate = str(last_year)
 
-        logger.info(f'Total Records: {num_records}')
+        logger.info('Total Records: %d', num_records)
         return records, num_records
         
 
@@ -118,11 +148,11 @@ class ObisHandler:
         """
         start = date_strings[0]
         end = date_strings[1]
-        if re.match(r"\d{4}-\d{2}-\d{2}", start):
+        if _ISO_DATE_RE.match(start):
             pass
         else:
             start = start + '-01-01'
-        if re.match(r"\d{4}-\d{2}-\d{2}", end):
+        if _ISO_DATE_RE.match(end):
             pass
         else:
             end = end + '-12-31'
@@ -138,27 +168,21 @@ class ObisHandler:
         Returns:
             None
         """
-        endpoint = '/occurrence'
-        scientificname = whales[self.whale]['scientificname']
         startdate, enddate = self.make_dateformat((startdate, enddate))
-        params = {'scientificname': scientificname, 'startdate': startdate, 'enddate': enddate, 'size': self.size}
+        params = {'scientificname': self.scientificname, 'startdate': startdate, 'enddate': enddate, 'size': self.size}
+
+        if self.is_fresh(Path(f'{self.data_dir}/{self.whale}/{startdate}--{enddate}.json')):
+            logger.info("Using saved /occurrence response for %s-%s", startdate, enddate)
+            return
         
-        logger.info(f"Sending /occurrence request for {startdate}-{enddate}")
-        response = self.api.request_api(endpoint, params)
+        logger.info("Sending /occurrence request for %s-%s", startdate, enddate)
+        response = self.api.request_api(self.api.occurrence_url, params, stream=True)
         self.save_json(response, startdate, enddate)
 
 
-    def handle_large_record(self, year: str, start: str, previous_record_year: str):
-        """Send a request for a large record"""
-        # request the previously iterated years
-        if start and previous_record_year:
-            self.get_occurrences(start, previous_record_year)
-        # request the large record
-        self.get_occurrences(year, year)
-        
-
     def save_json(self, response: requests.Response, startdate: str, enddate: str) -> None:
-        """Save a `requests.Response` to a json file
+        """Stream a `requests.Response` body to a json file.
+        The body is written to a temporary file first, so a failed download never leaves a partial json file.
         
         Args:
             response: requests.Response
@@ -169,33 +193,56 @@ class ObisHandler:
         """
         output_dir = Path(f'{self.data_dir}/{self.whale}')
         output_dir.mkdir(parents=True, exist_ok=True)
+        filename = output_dir / f'{startdate}--{enddate}.json'
+        tmp_filename = output_dir / f'{filename.name}.tmp'
 
-        with open(f'{output_dir}/{startdate}--{enddate}.json', 'w') as file:
-            logger.info(f'Saving json response to {file.name}')
-            json.dump(response.json(), file, ensure_ascii=False, indent=4)
+        try:
+            if not response.ok:
+                logger.info('Request for %s--%s failed with status %d', startdate, enddate, response.status_code)
+                return
+            with open(tmp_filename, 'wb') as file:
+                logger.info('Saving json response to %s', filename)
+                for chunk in response.iter_content(chunk_size=65536):
+                    file.write(chunk)
+            os.replace(tmp_filename, filename)
+        finally:
+            response.close()
+            tmp_filename.unlink(missing_ok=True)
 
 
-    def batch_requests(self) -> None:
-        """Send requests in batches to OBIS api if total records exceeds the size limit"""
-        records, num_records = self.get_records()
+    def plan_requests(self, records: List[Dict], num_records: int) -> List[Tuple[str, str]]:
+        """Group the yearly record counts into request windows that stay within the size limit.
+        No requests are sent here.
 
+        Args:
+            records: list[dict]
+                Response from the /statistics/years endpoint
+            num_records: int
+                Total number of records
+        Returns:
+            list of (startdate, enddate) tuples
+        """
         # make a single request if size is not exceeded
         if self.size >= num_records:
-            self.get_occurrences(self.startdate, self.enddate)
-            return
-        
+            return [(self.startdate, self.enddate)]
+
+        windows = []
         start = self.startdate
         previous_record_year = ''
         current_size = 0
 
         for i, record in enumerate(records):
+            # years stay ints, they are only turned into strings when a window is added
             year, year_records = record['year'], record['records']
             # update the start only if value was set to empty
             start = year if not start else start
 
             # if a single year's records exceed the size limit, save records to their own separate file
             if year_records > self.size:
-                self.handle_large_record(year, start, previous_record_year)
+                # request the previously iterated years, then the large record
+                if start and previous_record_year:
+                    windows.append((str(start), str(previous_record_year)))
+                windows.append((str(year), str(year)))
                 # new values to be set on next iteration
                 current_size = 0
                 start = ''
@@ -203,7 +250,7 @@ class ObisHandler:
                 continue
 
             if current_size + year_records > self.size:
-                self.get_occurrences(start, previous_record_year)
+                windows.append((str(start), str(previous_record_year)))
                 current_size = 0
                 start = year
 
@@ -212,4 +259,18 @@ class ObisHandler:
 
             # if last record is reached
             if i == len(records) - 1:
-                self.get_occurrences(start, self.enddate)
+                windows.append((str(start), self.enddate))
+
+        return windows
+
+
+    def batch_requests(self) -> None:
+        """Send requests in batches to OBIS api if total records exceeds the size limit"""
+        records, num_records = self.get_records()
+        windows = self.plan_requests(records, num_records)
+
+        # windows are independent and network bound, so they're requested concurrently
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.get_occurrences, startdate, enddate) for startdate, enddate in windows]
+            for future in futures:
+                future.result()
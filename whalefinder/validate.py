@@ -1,31 +1,89 @@
-from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
 from dateutil.parser import parse, ParserError
-import json
+from functools import lru_cache
 import logging
 from logging import INFO
+import os
 from pathlib import Path
-from pydantic import BaseModel, ConfigDict, Field, field_validator, ValidationError
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, TypeAdapter, ValidationError
 import re
 import sys
-from typing import Optional, Tuple
+from typing import Any, BinaryIO, Iterator, List, Optional, Tuple, Union
+from typing_extensions import Annotated
+
+from . import _json
+from ._config import check_whale
 
 logging.basicConfig(format='[%(asctime)s][%(module)s:%(lineno)04d] : %(message)s', level=INFO, stream=sys.stderr)
 logger = logging.getLogger(__name__)
 
-ROOT_DIR = Path().cwd()
-with open(f"{ROOT_DIR}/config.json", 'r') as file:
-    config = json.load(file)
-whales = config['whales']
+# occurrence files are saved as '{startdate}--{enddate}.json'
+_FILE_RE = re.compile(r'(\d{4})-\d{2}-\d{2}\--(\d{4})-\d{2}-\d{2}')
+# eventDate formats that dateutil can parse, but with values removed or added unintentionally
+_BAD_DATE_RE = re.compile(r'''
+    ^(?:
+        \d{4}-\d{1,2}         # 1990-03
+      | \d{1,2}-\d{4}         # 03-1990
+      | \d{1,4}               # 1985
+      | \d{1,2}\ [A-Za-z]+    # 20 Nov
+      | [A-Za-z]+\ \d{1,2}    # Oct 15
+      | [A-Za-z]+\ \d{4}      # Oct 1970
+      | \d{4}\ [A-Za-z]+      # 1970 Oct
+      | .*/.*                 # string with any '/' character
+    )$
+''', re.VERBOSE)
+# accepted ISO eventDate formats: a date, optionally followed by a time and a 'Z' or numeric utc offset
+_ISO_EVENT_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?(?:Z|[+-]\d{2}(?::?\d{2})?)?)?', re.ASCII)
+
+
+@lru_cache(maxsize=16384)
+def _parse_event_date(value: str) -> date:
+    """
+    Parse an eventDate string, raising ValueError for bad formats.
+    OBIS responses repeat the same eventDate across many records, so results are cached per string
+
+    accepted format examples: 
+    '1913-03-17', '1849-12-04 23:12:00', '1849-12-04T23:12:00', 
+    '1849-12-04T23:12:00Z', '1971-01-01 00:00:00+00', '1910-12-24T02:00'
+
+    unaccepted format examples:
+    (these formats are parsable, but values end up being removed or added unintentionally)
+    '1800-01-01/1874-06-24', '1925-11', June 1758, etc.
+
+    Args:
+        value: str
+    Returns:
+        date
+    """
+    iso_prefixed = len(value) >= 10 and value[4] == '-' and value[7] == '-' and '/' not in value
+    # fast path for the accepted ISO formats only, fromisoformat accepts other values that dateutil rejects
+    # on newer Pythons. dateutil is only needed for values fromisoformat rejects
+    if iso_prefixed and _ISO_EVENT_DATE_RE.fullmatch(value):
+        iso_value = value[:-1] + '+00:00' if value.endswith('Z') else value
+        try:
+            return datetime.fromisoformat(iso_value).date()
+        except ValueError:
+            pass
+    # Matching bad values should be handled further down the script.
+    # No bad format can match an ISO prefixed value without a '/', so the regex only runs for other values
+    elif not iso_prefixed and _BAD_DATE_RE.match(value):
+        raise ValueError(f"eventDate '{value}' is a bad format.")
+    return parse(value).date()
+
+
+# pydantic-core calls the parser directly before validating the date
+EventDate = Annotated[date, BeforeValidator(_parse_event_date)]
 
 
 class Results(BaseModel):
     """
     Pydantic model to validate Obis API responses against.
     """
-    model_config = ConfigDict(arbitrary_types_allowed=True, extra='ignore')
+    model_config = ConfigDict(frozen=True, extra='ignore')
 
     occurrenceID: str = Field(default=None)
-    eventDate: date
+    eventDate: EventDate
     verbatimEventDate: str = Field(default=None)
     decimalLatitude: float
     decimalLongitude: float
@@ -37,33 +95,77 @@ class Results(BaseModel):
     basisOfRecord: str = Field(default=None)
     bibliographicCitation: str = Field(default=None)
 
-    @field_validator('eventDate', mode='before')
-    @classmethod
-    def check_eventdate(cls, value) -> date:
-        """
-        accepted format examples: 
-        '1913-03-17', '1849-12-04 23:12:00', '1849-12-04T23:12:00', 
-        '1849-12-04T23:12:00Z', '1971-01-01 00:00:00+00', '1910-12-24T02:00'
 
-        unaccepted format examples:
-        (these formats are parsable, but values end up being removed or added unintentionally)
-        '1800-01-01/1874-06-24', '1925-11', June 1758, etc.
-        """
-        bad_formats = [
-            r'^\d{4}-\d{1,2}$', # 1990-03
-            r'^\d{1,2}-\d{4}$', # 03-1990
-            r'^\d{1,4}$', # 1985
-            r'^\d{1,2} [A-Za-z]+$', # 20 Nov
-            r'^[A-Za-z]+ \d{1,2}$', # Oct 15
-            r'^[A-Za-z]+ \d{4}$', # Oct 1970
-            r'^\d{4} [A-Za-z]+$', # 1970 Oct
-            r'^.*/.*$' # string with any '/' character
-        ]
-        # Matching bad values should be handled further down the script
-        for fmt in bad_formats:
-            if re.match(fmt, value):
-                raise ValueError(f"eventDate '{value}' is a bad format.")
-        return parse(value).date()
+def _parse_year(date_str: Optional[str]) -> Optional[int]:
+    """
+    Year of a 'YYYY' or 'YYYY-MM-DD' string, None if the string is empty
+
+    Raises:
+        ValueError: if the string is in neither format
+    """
+    if not date_str:
+        return None
+    if len(date_str) == 4:
+        return int(date_str)
+    return date.fromisoformat(date_str[:10]).year
+
+
+# Results field names, and defaults of the optional fields, for records that fail validation
+_RESULTS_FIELDS = tuple(Results.model_fields)
+_RESULTS_DEFAULTS = {name: field.get_default() for name, field in Results.model_fields.items() if not field.is_required()}
+
+# Validates a whole batch in one call. Records that fail fall through to Any
+# and are returned unchanged, so one bad record doesn't fail the batch.
+_RESULTS_BATCH = TypeAdapter(List[Annotated[Union[Results, Any], Field(union_mode='left_to_right')]])
+_RESULTS_LIST = TypeAdapter(List[Results])
+_RESULTS_ITEM = TypeAdapter(Results)
+
+
+def _validate_records(records: List[dict]) -> Tuple[List[dict], List[dict]]:
+    """
+    Validate records against the Results model
+
+    Args:
+        records: list[dict]
+    Returns:
+        Tuple containing a list of validated records and a list of errors
+    """
+    occurrences = []
+    errors = []
+
+    for item, result in zip(records, _RESULTS_BATCH.validate_python(records)):
+        if isinstance(result, Results):
+            occurrences.append(result)
+            continue
+        # validate the failed item on its own to get its error details
+        try:
+            _RESULTS_ITEM.validate_python(item)
+        except ValidationError as e:
+            # keep only the saved keys and extract detail location from tuple
+            error_details = [
+                {'type': detail['type'], 'loc': detail['loc'][0], 'msg': detail['msg']}
+                for detail in e.errors(include_context=False, include_input=False, include_url=False)
+            ]
+            # remove extra keys from item and fill in missing optional fields
+            filtered_item = {name: item[name] for name in _RESULTS_FIELDS if name in item}
+            for name, default in _RESULTS_DEFAULTS.items():
+                filtered_item.setdefault(name, default)
+            errors.append({'details': error_details, 'data': filtered_item})
+
+    return _RESULTS_LIST.dump_python(occurrences, mode='json'), errors
+
+
+def _validate_file(path: Path) -> Tuple[List[dict], List[dict]]:
+    """
+    Load and validate a single occurrence file.
+    Kept at module level so it can be sent to worker processes
+
+    Args:
+        path: Path
+    Returns:
+        Tuple containing a list of validated records and a list of errors
+    """
+    return _validate_records(_json.load(path).get('results', []))
 
 
 class Validator:
@@ -72,19 +174,25 @@ class Validator:
     """
     data_dir = './data'
 
-    def __init__(self, whale: str, startdate: Optional[str]=None, enddate: Optional[str]=None) -> None:
+    def __init__(
+            self, whale: str, startdate: Optional[str]=None, enddate: Optional[str]=None, max_workers: Optional[int]=None
+    ) -> None:
         """
         whale: str
             Name of file directory to search
         startdate, enddate: str
             Date range of files to match
+        max_workers: int, optional
+            Maximum number of processes validating files at once, defaults to the number of CPUs.
+            1 validates every file in this process
         """
-        if whale in whales:
-            self.whale = whale
-        else:
-            raise ValueError(f'{whale} not in whales dictionary. {whales.keys()}')
+        self.whale = check_whale(whale)
         self.startdate = startdate
         self.enddate = enddate
+        # years compared against file names, parsed once. Malformed dates fail here
+        self._start_year = _parse_year(startdate)
+        self._end_year = _parse_year(enddate)
+        self.max_workers = max_workers
 
     def match_files(self) -> list:
         """
@@ -94,98 +202,73 @@ class Validator:
             list[Path]
         """
         whale_dir = Path(f'{self.data_dir}/{self.whale}')
-        reg_pattern = r'\d{4}-\d{2}-\d{2}\--\d{4}-\d{2}-\d{2}'
-        files = []
+        # empty dates are open bounds, so every file goes through the same comparison
+        start_year = -sys.maxsize if self._start_year is None else self._start_year
+        end_year = sys.maxsize if self._end_year is None else self._end_year
         matched_files = []
-        for file in whale_dir.glob('*.json'):
-            if re.search(reg_pattern, file.name):
-                files.append(file)
-
-        if files:
-            if self.startdate and self.enddate:
-                start_year = parse(self.startdate).year
-                end_year = parse(self.enddate).year
-
-                for file in files:
-                    match = re.search(r'(\d{4})-\d{2}-\d{2}\--(\d{4})-\d{2}-\d{2}', file.name)
-                    if match:
-                        file_start_year = int(match.group(1))
-                        file_end_year = int(match.group(2))
-
-                        if start_year <= file_start_year <= end_year and start_year <= file_end_year <= end_year:
-                            matched_files.append(file)
-
-            elif self.startdate and not self.enddate:
-                start_year = parse(self.startdate).year
-
-                for file in files:
-                    match = re.search(r'(\d{4})-\d{2}-\d{2}\--\d{4}-\d{2}-\d{2}', file.name)
-                    if match:
-                        file_start_year = int(match.group(1))
-
-                        if start_year <= file_start_year:
-                            matched_files.append(file)
-
-            elif not self.startdate and self.enddate:
-                end_year = parse(self.enddate).year
-
-                for file in files:
-                    match = re.search(r'\d{4}-\d{2}-\d{2}\--(\d{4})-\d{2}-\d{2}', file.name)
-                    if match:
-                        file_end_year = int(match.group(1))
+        if not whale_dir.is_dir():
+            return matched_files
 
-                        if file_end_year <= end_year:
-                            matched_files.append(file)
+        # DirEntry caches file type info, names are checked before any regex runs
+        with os.scandir(whale_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not (name[:1].isdigit() and name.endswith('.json') and entry.is_file()):
+                    continue
+                match = _FILE_RE.search(name)
+                if not match:
+                    continue
+                # a file matches if its date range lies within the given start and end years
+                if start_year <= int(match.group(1)) and int(match.group(2)) <= end_year:
+                    matched_files.append(Path(entry.path))
 
-            else:
-                return files
-            
-            return matched_files
+        return matched_files
 
-    def get_data(self) -> dict:
+    def iter_results(self) -> Iterator[Tuple[List[dict], List[dict]]]:
         """
-        Load data from multiple files into a single dictionary
+        Yield the validated records and errors of each matched file, in file order.
+        Files are independent and validation is CPU bound, so more than one file is spread across worker processes
 
         Returns:
-            dict
+            Iterator[tuple[list[dict], list[dict]]]
         """
         files = self.match_files()
-        data = {'results': []}
-
-        for file in files:
-            with open(file) as f:
-                results = json.load(f)
-                if 'results' in results.keys():
-                    for d in results['results']:
-                        data['results'].append(d)
+        workers = min(len(files), self.max_workers or os.cpu_count() or 1)
+        if workers <= 1:
+            yield from map(_validate_file, files)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(_validate_file, files)
 
-        return data
-
-    def validate_response(self) -> Tuple[dict, dict]:
+    def validate_response(
+            self, valid_out: Optional[BinaryIO]=None, error_out: Optional[BinaryIO]=None
+    ) -> Tuple[dict, dict]:
         """
         Validate data from API response
 
+        Args:
+            valid_out, error_out: BinaryIO, optional
+                Binary files to stream valid records and errors to as newline delimited json, one per line.
+                Records written to a file are not kept in the returned dicts
         Returns:
             Tuple containing a dict of valid data and a dict of error data
         """
         valid_data = {'validated': []}
         error_data = {'errors': []}
+        num_valid = 0
         num_errors = 0
-        data = self.get_data()
-
-        for item in data['results']:
-            try:
-                occurrence = Results(**item)
-                valid_data['validated'].append(occurrence.model_dump(mode='json'))
-            except ValidationError as e:
-                error_details = e.errors(include_context=False, include_input=False, include_url=False)
-                # extract detail location from tuple
-                for detail in error_details:
-                    detail['loc'] = detail['loc'][0]
-                # remove extra keys from item
-                filtered_item = Results.model_construct(**item).model_dump(mode='json', warnings=False)
-                error_data['errors'].append({'details': error_details, 'data': filtered_item})
-                num_errors += len(error_details)
-
-        logger.info(f"Validated: {len(valid_data['validated'])}, Errors: {num_errors}")
+
+        for validated, errors in self.iter_results():
+            num_valid += len(validated)
+            num_errors += sum(len(error['details']) for error in errors)
+            if valid_out is None:
+                valid_data['validated'].extend(validated)
+            else:
+                valid_out.writelines(_json.dumps(record) + b'\n' for record in validated)
+            if error_out is None:
+                error_data['errors'].extend(errors)
+            else:
+                error_out.writelines(_json.dumps(error) + b'\n' for error in errors)
+
+        logger.info("Validated: %d, Errors: %d", num_valid, num_errors)
         return valid_data, error_data